@@ -1,76 +1,329 @@
-from flask import Flask, render_template, request, send_file
-from flask_socketio import SocketIO, emit
+import eventlet
+eventlet.monkey_patch()  # must run before anything imports socket/threading
+
+from flask import Flask, Response, render_template, request, send_file, jsonify
+from flask.json.provider import DefaultJSONProvider
+from flask_socketio import SocketIO, join_room
+import io
+import logging
+import orjson
 import os
-from werkzeug.utils import secure_filename
-from groq_transcribe import transcribe_audio
+import re
+import requests
+from collections import OrderedDict
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from streaming_form_data import StreamingFormDataParser
+from streaming_form_data.parser import ParseFailedException
+from streaming_form_data.targets import BaseTarget, ValueTarget
+from groq import APITimeoutError
+from groq_transcribe import transcribe_audio, is_silent, get_vision_response
+from groq_llama import get_llama_response, init_conversation_log
 from google_llm import call_google_llm
 from recommend_flower import recommend_flower
 from eleven_tts import synthesize_speech
 
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask's default JSON provider with orjson doing the encoding and
+    decoding; sort_keys, compact/indent and its default() conversions (HTTP
+    dates, dataclasses, __html__) behave as before"""
+
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+        if kwargs.get("sort_keys", self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        if kwargs.get("indent"):
+            option |= orjson.OPT_INDENT_2
+        text = orjson.dumps(obj, default=kwargs.get("default", self.default), option=option).decode()
+        if kwargs.get("ensure_ascii", self.ensure_ascii) and not text.isascii():
+            # orjson always writes UTF-8; keep the \u escapes clients got before
+            return super().dumps(obj, **kwargs)
+        return text
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger(__name__)
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'default-dev-key')
-socketio = SocketIO(app, cors_allowed_origins="*")
+app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
+# The provider's dumps/loads match the json-module interface Socket.IO expects
+socketio = SocketIO(app, async_mode='eventlet', json=app.json, cors_allowed_origins="*")
 
-@app.route('/')
-def index():
-    return render_template('index.html')
+UPLOAD_CHUNK_SIZE = 64 * 1024
+BROADCAST_BATCH_SIZE = 50
+TEMP_DIR = tempfile.gettempdir()
+NO_SPEECH_REPLY = "Sorry, I didn't catch that."
+FAILURE_REPLY = "Sorry, something went wrong. Please try again."
+PIPELINE_DEADLINE = 30.0  # seconds from upload to broadcast
+MAX_TRANSCRIPT_CHARS = 2000  # ~500 tokens; caps LLM input cost per turn
+SESSION_ID = re.compile(r"[\w-]{1,64}")
 
-@app.route('/transcribe', methods=['POST'])
-def handle_transcribe():
-    print("✅ Hit /transcribe route")
+# Text-only turns go to Gemini, or with LLM_PROVIDER=groq to Llama with a
+# per-session history; turns with an image always go to the Groq vision path
+LLM_PROVIDER = os.environ.get('LLM_PROVIDER', 'gemini')
+if LLM_PROVIDER not in ('gemini', 'groq'):
+    raise ValueError("LLM_PROVIDER must be 'gemini' or 'groq'")
+if LLM_PROVIDER == 'groq':
+    init_conversation_log()  # restores sessions if CONVERSATION_LOG is set
 
-    if 'audio' not in request.files:
-        print("❌ No audio file part in the request")
-        return "No audio file", 400
+# TTS audio for recent jobs, served from memory at /audio/<job_id>.mp3
+TTS_AUDIO_KEEP = 32
+tts_audio = OrderedDict()
+
+class RequestExpired(Exception):
+    """A pipeline job ran past its deadline or lost everyone it would reply to"""
+
+class AudioBuffer:
+    """A job's TTS audio, readable while it is still arriving from ElevenLabs"""
+
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self._changed = threading.Condition()
+
+    def fill(self, chunks):
+        try:
+            for chunk in chunks:
+                with self._changed:
+                    self.chunks.append(chunk)
+                    self._changed.notify_all()
+        except requests.RequestException as e:
+            # The reply text is already out; the audio just ends early
+            logger.warning("⚠️ TTS stream broke off: %s", e)
+        finally:
+            with self._changed:
+                self.done = True
+                self._changed.notify_all()
+
+    def __iter__(self):
+        """Yield every chunk so far, then each new one until the audio is complete"""
+        sent = 0
+        while True:
+            with self._changed:
+                while sent == len(self.chunks) and not self.done:
+                    self._changed.wait()
+                if sent == len(self.chunks):
+                    return
+                chunk = self.chunks[sent]
+            sent += 1
+            yield chunk
+
+class FdTarget(BaseTarget):
+    """Streaming form-data target that writes a part into an open file descriptor"""
+
+    def __init__(self, fd):
+        super().__init__()
+        self._fd = fd
+
+    def on_data_received(self, chunk):
+        os.write(self._fd, chunk)
+
+def open_temp_audio():
+    """Open a private scratch file for one upload and return (fd, path)"""
+    if sys.platform == 'linux':
+        # Anonymous file: never appears in the directory and is unlinked by
+        # the kernel as soon as the descriptor is closed.
+        try:
+            fd = os.open(TEMP_DIR, os.O_TMPFILE | os.O_RDWR, 0o600)
+            return fd, f"/proc/self/fd/{fd}"
+        except OSError:
+            pass  # filesystem without O_TMPFILE support
+    temp_path = os.path.join(TEMP_DIR, f"{uuid.uuid4().hex}.wav")
+    return os.open(temp_path, os.O_CREAT | os.O_EXCL | os.O_RDWR, 0o600), temp_path
+
+def close_temp_audio(fd, temp_path):
+    os.close(fd)
+    if not temp_path.startswith("/proc/self/fd/"):
+        os.remove(temp_path)
 
-    audio_file = request.files['audio']
-    if audio_file.filename == '':
-        print("❌ Empty filename")
-        return "Empty filename", 400
+# Connected clients are spread over rooms of at most BROADCAST_BATCH_SIZE so
+# a broadcast goes out one room (one encoded packet) at a time
+batch_rooms = {}  # room name -> member count
+client_rooms = {}  # sid -> room name
 
-    filename = secure_filename("speech.wav")
-    filepath = os.path.join("static", filename)
-    audio_file.save(filepath)
+def broadcast_batched(event, payload):
+    """Emit to every connected client, yielding to the event loop between batches"""
+    for room, members in list(batch_rooms.items()):
+        if members:
+            socketio.emit(event, payload, to=room)
+            socketio.sleep(0)
 
-    print(f"➡️ request.files: {request.files}")
-    transcript = transcribe_audio(filepath)
-    print(f"📝 Transcript:  {transcript}")
+def has_listeners():
+    return bool(client_rooms)
 
-    response = call_google_llm(transcript)
-    print(f"🤖 AI response: {response}")
+def remaining_time(deadline, stage):
+    """Seconds left before the deadline; raise instead of starting a paid stage for nobody"""
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise RequestExpired(f"deadline passed before {stage}")
+    if not has_listeners():
+        raise RequestExpired(f"no clients connected before {stage}")
+    return remaining
+
+@app.route('/')
+def index():
+    return render_template('index.html')
+
+def process_transcription(job_id, fd, temp_path, deadline, image, session_id):
+    """Run the transcribe -> LLM -> TTS pipeline for one upload and broadcast the result"""
+    try:
+        try:
+            run_pipeline(job_id, fd, temp_path, deadline, image, session_id)
+        except (requests.Timeout, APITimeoutError, TimeoutError) as e:
+            # Each call's timeout is the time left, so this is the deadline
+            # running out mid-call rather than between stages
+            raise RequestExpired(f"deadline passed during a call: {e}") from e
+    except RequestExpired as e:
+        logger.warning("⏱️ Dropped job %s: %s", job_id, e)
+    except Exception:
+        # /transcribe has already answered 202, so the page only learns of
+        # the failure from this broadcast
+        logger.exception("❌ Job %s failed", job_id)
+        broadcast_batched('conversation_update', {
+            'job_id': job_id,
+            'user_message': {'text': '', 'type': 'user'},
+            'ai_response': {'text': FAILURE_REPLY, 'type': 'assistant'},
+            'audio_url': None
+        })
+
+def run_pipeline(job_id, fd, temp_path, deadline, image, session_id):
+    try:
+        if is_silent(temp_path):
+            logger.info("🔇 Audio too short or quiet, skipping transcription")
+            broadcast_batched('conversation_update', {
+                'job_id': job_id,
+                'user_message': {'text': '', 'type': 'user'},
+                'ai_response': {'text': NO_SPEECH_REPLY, 'type': 'assistant'},
+                'audio_url': None
+            })
+            return
+        transcript = transcribe_audio(temp_path, timeout=remaining_time(deadline, "transcription"))
+    finally:
+        close_temp_audio(fd, temp_path)
+    transcript = transcript.strip()[:MAX_TRANSCRIPT_CHARS]
+    logger.info("📝 Transcript:  %s", transcript)
+
+    timeout = remaining_time(deadline, "LLM")
+    if image:
+        response = get_vision_response(transcript, image, timeout=timeout)
+    elif LLM_PROVIDER == 'groq':
+        response = get_llama_response(transcript, session_id, timeout=timeout)
+    else:
+        response = call_google_llm(transcript, timeout=timeout)
+    logger.info("🤖 AI response: %s", response)
 
     flower = recommend_flower(transcript)
     response += f"\n\nSuggested Product (Google AI): {flower}"
 
-    tts_result = synthesize_speech(response)
-    if tts_result:
-        print("🔊 TTS audio generated successfully.")
+    # Broadcast as soon as ElevenLabs has accepted the text; the page starts
+    # playing while the rest of the audio is still being synthesised
+    chunks = synthesize_speech(response, timeout=remaining_time(deadline, "TTS"))
+    if chunks:
+        audio = tts_audio[job_id] = AudioBuffer()
+        if len(tts_audio) > TTS_AUDIO_KEEP:
+            tts_audio.popitem(last=False)
     else:
-        print("⚠️ Skipped TTS or failed to generate audio.")
+        logger.warning("⚠️ Skipped TTS or failed to generate audio.")
 
-    socketio.emit('response', {
-        'transcript': transcript,
-        'response': response
+    broadcast_batched('conversation_update', {
+        'job_id': job_id,
+        'user_message': {'text': transcript, 'type': 'user'},
+        'ai_response': {'text': response, 'type': 'assistant'},
+        'audio_url': f"/audio/{job_id}.mp3" if chunks else None
     })
 
-    return "OK", 200
+    if chunks:
+        audio.fill(chunks)
+        logger.info("🔊 TTS audio generated successfully.")
+
+@app.route('/transcribe', methods=['POST'])
+def handle_transcribe():
+    logger.debug("✅ Hit /transcribe route")
+
+    if request.mimetype != 'multipart/form-data':
+        logger.warning("❌ No audio file part in the request")
+        return "No audio file", 400
+
+    deadline = time.monotonic() + PIPELINE_DEADLINE
+    fd, temp_path = open_temp_audio()
+    handed_off = False
+    try:
+        # Parse the multipart body straight off the socket so the audio bytes go
+        # to disk as they arrive instead of through Werkzeug's form parser.
+        audio_target = FdTarget(fd)
+        image_target = ValueTarget()  # optional photo to ask about
+        session_target = ValueTarget()  # the page's conversation id
+        try:
+            parser = StreamingFormDataParser(headers=request.headers)
+            parser.register('audio', audio_target)
+            parser.register('image', image_target)
+            parser.register('session_id', session_target)
+            while chunk := request.stream.read(UPLOAD_CHUNK_SIZE):
+                parser.data_received(chunk)
+        except ParseFailedException:
+            logger.warning("❌ Malformed multipart body")
+            return "Malformed multipart body", 400
+
+        if audio_target.multipart_filename is None:
+            logger.warning("❌ No audio file part in the request")
+            return "No audio file", 400
+
+        if audio_target.multipart_filename == '':
+            logger.warning("❌ Empty filename")
+            return "Empty filename", 400
+
+        # The remote calls take seconds; hand them to a background task so
+        # this worker is free for the next upload. The task owns the fd now.
+        job_id = uuid.uuid4().hex
+        session_id = session_target.value.decode('utf-8', 'replace')
+        if not SESSION_ID.fullmatch(session_id):
+            session_id = job_id  # no usable id: a one-turn conversation
+        socketio.start_background_task(process_transcription, job_id, fd, temp_path, deadline,
+                                       image_target.value or None, session_id)
+        handed_off = True
+    finally:
+        if not handed_off:
+            close_temp_audio(fd, temp_path)
+
+    return jsonify({'job_id': job_id}), 202
+
+@app.route('/audio/<job_id>.mp3')
+def serve_audio(job_id):
+    audio = tts_audio.get(job_id)
+    if audio is None or (audio.done and not audio.chunks):
+        return "Audio not found", 404
+    if not audio.done:
+        return Response(iter(audio), mimetype='audio/mpeg')
+    # Complete audio goes through send_file for Range and caching support
+    return send_file(io.BytesIO(b"".join(audio.chunks)), mimetype='audio/mpeg')
 
 @socketio.on('connect')
 def handle_connect():
-    print("⚡ Client connected")
-    emit('response', {'data': 'Connected'})
+    room = next((r for r, members in batch_rooms.items() if members < BROADCAST_BATCH_SIZE), None)
+    if room is None:
+        room = f"listeners-{len(batch_rooms)}"
+    join_room(room)
+    batch_rooms[room] = batch_rooms.get(room, 0) + 1
+    client_rooms[request.sid] = room
+    logger.info("⚡ Client connected")
 
 @socketio.on('disconnect')
 def handle_disconnect():
-    print("🔌 Client disconnected")
-
-# Ensure output.mp3 file exists to avoid 404 errors
-if not os.path.exists("static"):
-    os.makedirs("static", exist_ok=True)
-
-if not os.path.exists("static/output.mp3"):
-    open("static/output.mp3", "wb").close()
+    # Socket.IO drops the sid from its rooms itself; only the counts are ours
+    room = client_rooms.pop(request.sid, None)
+    if room is not None:
+        batch_rooms[room] -= 1
+    logger.info("🔌 Client disconnected")
 
 if __name__ == '__main__':
-    socketio.run(app, debug=True, host='0.0.0.0')
+    # Debug mode (reloader + interactive debugger) only when asked for
+    debug = os.environ.get('FLASK_DEBUG') == '1'
+    socketio.run(app, debug=debug, use_reloader=debug, host='0.0.0.0')
 
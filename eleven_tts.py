@@ -1,39 +1,94 @@
 # eleven_tts.py
 
+import logging
 import os
+from collections import OrderedDict
+from functools import partial
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
+import upstream
 
 load_dotenv()
+logger = logging.getLogger(__name__)
 ELEVENLABS_API_KEY = os.getenv("ELEVENLABS_API_KEY")
 ELEVEN_VOICE_ID = os.getenv("ELEVEN_VOICE_ID", "EXAVITQu4vr4xnSDxMaL")  # default voice
 
-def synthesize_speech(text, filename="static/output.mp3"):
+# Keep-alive session: later TTS calls skip the TCP + TLS handshake. Each
+# synthesis is billed, so only refused requests are resent (upstream.call).
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=20))
+SESSION.headers.update({
+    "xi-api-key": ELEVENLABS_API_KEY or "",
+    "Content-Type": "application/json"
+})
+
+# The /stream endpoint sends MP3 frames as they are synthesised, so playback
+# can start before the whole reply has been spoken
+TTS_URL = f"https://api.elevenlabs.io/v1/text-to-speech/{ELEVEN_VOICE_ID}/stream"
+AUDIO_CHUNK_SIZE = 4096
+BREAKER = upstream.CircuitBreaker("ElevenLabs")
+VOICE_SETTINGS = {
+    "stability": 0.5,
+    "similarity_boost": 0.75
+}
+
+# MP3 bytes for recently spoken texts, least recently used first. Voice and
+# settings are fixed per process, so the text alone is the key.
+AUDIO_CACHE_SIZE = 64
+_audio_cache = OrderedDict()
+
+class TTSError(Exception):
+    """ElevenLabs answered with an error status"""
+
+def _post(body, timeout):
+    try:
+        response = SESSION.post(TTS_URL, data=body, timeout=timeout, stream=True)
+    except requests.RequestException as e:
+        if upstream.never_sent(e):
+            raise upstream.Transient(f"ElevenLabs unreachable: {e}") from e
+        raise
+    if response.status_code in upstream.RETRY_STATUSES:
+        raise upstream.Transient(f"ElevenLabs API error: {response.status_code} - {response.text}",
+                                 upstream.retry_after(response.headers))
+    if response.status_code != 200:
+        raise TTSError(f"ElevenLabs API error: {response.status_code} - {response.text}")
+    return response
+
+def _read_audio(text, response):
+    parts = []
+    with response:
+        for chunk in response.iter_content(AUDIO_CHUNK_SIZE):
+            parts.append(chunk)
+            yield chunk
+    # Only complete audio is cached; a stream cut short is not replayed
+    _audio_cache[text] = b"".join(parts)
+    if len(_audio_cache) > AUDIO_CACHE_SIZE:
+        _audio_cache.popitem(last=False)
+
+def synthesize_speech(text, timeout=None):
+    """Return an iterator over the MP3 bytes for text as ElevenLabs produces
+    them, or None if TTS is unavailable or fails before any audio arrives"""
     if not ELEVENLABS_API_KEY:
-        print("⚠️ ELEVENLABS_API_KEY not found in .env – skipping TTS generation.")
+        logger.warning("⚠️ ELEVENLABS_API_KEY not found in .env – skipping TTS generation.")
         return None
 
-    url = f"https://api.elevenlabs.io/v1/text-to-speech/{ELEVEN_VOICE_ID}"
-    headers = {
-        "xi-api-key": ELEVENLABS_API_KEY,
-        "Content-Type": "application/json"
-    }
+    audio = _audio_cache.get(text)
+    if audio is not None:
+        _audio_cache.move_to_end(text)
+        return iter((audio,))
+
     data = {
         "text": text,
         "model_id": "eleven_monolingual_v1",
-        "voice_settings": {
-            "stability": 0.5,
-            "similarity_boost": 0.75
-        }
+        "voice_settings": VOICE_SETTINGS
     }
 
-    response = requests.post(url, headers=headers, json=data)
-    if response.status_code != 200:
-        print(f"❌ ElevenLabs API error: {response.status_code} - {response.text}")
+    try:
+        response = upstream.call(BREAKER, partial(_post, orjson.dumps(data)), timeout)
+    except (upstream.CircuitOpen, upstream.Transient, TTSError) as e:
+        logger.error("❌ %s", e)
         return None
 
-    with open(filename, "wb") as f:
-        f.write(response.content)
-
-    return filename
-
+    return _read_audio(text, response)
@@ -1,6 +1,13 @@
 import os
+import re
+import time
+from collections import OrderedDict
+from functools import partial
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
+import upstream
 
 load_dotenv()
 
@@ -8,10 +15,57 @@ GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 if not GOOGLE_API_KEY:
     raise ValueError("GOOGLE_API_KEY not found in environment variables")
 
-def call_google_llm(prompt):
-    url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-pro-latest:generateContent"
-    headers = { "Content-Type": "application/json" }
-    params = { "key": GOOGLE_API_KEY }
+# One pooled session per module so repeat calls reuse the TLS connection.
+# Retries are left to upstream.call, which only resends refused requests.
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=20))
+SESSION.headers["Content-Type"] = "application/json"
+SESSION.params = {"key": GOOGLE_API_KEY}
+
+GEMINI_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-pro-latest:generateContent"
+BREAKER = upstream.CircuitBreaker("Gemini")
+
+# Answers to recent prompts, keyed on the normalised prompt text so that
+# repeats differing only in case, spacing or trailing punctuation skip the
+# API call. Other symbols are kept: "2+2" and "2-2" are different questions.
+RESPONSE_CACHE_TTL = 300  # seconds
+RESPONSE_CACHE_SIZE = 256
+_response_cache = OrderedDict()
+cache_metrics = {"hits": 0, "misses": 0}
+# Questions whose answer depends on when they are asked are never cached
+_TIME_SENSITIVE = re.compile(r"\b(now|today|tonight|tomorrow|yesterday|current|currently|latest|time|weather)\b", re.I)
+MIN_CACHEABLE_CHARS = 4
+
+def _cache_key(prompt):
+    return " ".join(prompt.lower().split()).rstrip(".!? ")
+
+def _is_cacheable(prompt):
+    return len(prompt) >= MIN_CACHEABLE_CHARS and not _TIME_SENSITIVE.search(prompt)
+
+def _post(body, timeout):
+    try:
+        response = SESSION.post(GEMINI_URL, data=body, timeout=timeout)
+    except requests.RequestException as e:
+        if upstream.never_sent(e):
+            raise upstream.Transient(f"Google API unreachable: {e}") from e
+        raise
+    if response.status_code in upstream.RETRY_STATUSES:
+        raise upstream.Transient(f"Google API error: {response.status_code} - {response.text}",
+                                 upstream.retry_after(response.headers))
+    if response.status_code != 200:
+        raise Exception(f"Google API error: {response.status_code} - {response.text}")
+    return response
+
+def call_google_llm(prompt, timeout=None):
+    key = _cache_key(prompt) if _is_cacheable(prompt) else None
+    if key is not None:
+        cached = _response_cache.get(key)
+        if cached and time.monotonic() - cached[0] < RESPONSE_CACHE_TTL:
+            _response_cache.move_to_end(key)
+            cache_metrics["hits"] += 1
+            return cached[1]
+        cache_metrics["misses"] += 1
+
     data = {
         "contents": [{
             "role": "user",
@@ -19,11 +73,13 @@ def call_google_llm(prompt):
         }]
     }
 
-    response = requests.post(url, headers=headers, params=params, json=data)
-
-    if response.status_code != 200:
-        raise Exception(f"Google API error: {response.status_code} - {response.text}")
-
-    json_response = response.json()
-    return json_response["candidates"][0]["content"]["parts"][0]["text"]
+    response = upstream.call(BREAKER, partial(_post, orjson.dumps(data)), timeout)
+    json_response = orjson.loads(response.content)
+    text = json_response["candidates"][0]["content"]["parts"][0]["text"]
+    if key is not None:
+        _response_cache[key] = (time.monotonic(), text)
+        _response_cache.move_to_end(key)
+        if len(_response_cache) > RESPONSE_CACHE_SIZE:
+            _response_cache.popitem(last=False)
+    return text
 
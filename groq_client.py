@@ -0,0 +1,48 @@
+# groq_client.py
+
+import os
+import httpx
+from groq import APIConnectionError, APIStatusError, Groq, NOT_GIVEN, RateLimitError
+from dotenv import load_dotenv
+import upstream
+
+load_dotenv()
+
+GROQ_API_KEY = os.getenv("GROQ_API_KEY")
+if not GROQ_API_KEY:
+    raise ValueError("GROQ_API_KEY not found in environment variables")
+
+# One client (and so one httpx connection pool) for every Groq caller.
+# HTTP/2 multiplexes concurrent jobs over a few warm TLS connections. Neither
+# the transport nor the SDK retries; requests that should be resent go
+# through call() below, the one retry layer.
+http_client = httpx.Client(
+    transport=httpx.HTTPTransport(
+        http2=True,
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=64, keepalive_expiry=60),
+    ),
+    timeout=httpx.Timeout(30.0, connect=5.0),
+)
+client = Groq(api_key=GROQ_API_KEY, max_retries=0, http_client=http_client)
+breaker = upstream.CircuitBreaker("Groq")
+
+def _attempt(attempt, timeout):
+    try:
+        return attempt(NOT_GIVEN if timeout is None else timeout)
+    except RateLimitError as e:
+        raise upstream.Transient(str(e), upstream.retry_after(e.response.headers)) from e
+    except APIStatusError as e:
+        if e.status_code in upstream.RETRY_STATUSES:
+            raise upstream.Transient(str(e), upstream.retry_after(e.response.headers)) from e
+        raise
+    except APIConnectionError as e:
+        if isinstance(e.__cause__, httpx.ConnectError):
+            raise upstream.Transient(str(e)) from e
+        raise
+
+def call(attempt, timeout=NOT_GIVEN):
+    """Run attempt(timeout), one Groq request, through the shared circuit
+    breaker, resending it only if Groq refused it or it never connected; all
+    attempts together stay within timeout"""
+    budget = None if timeout is NOT_GIVEN else timeout
+    return upstream.call(breaker, lambda t: _attempt(attempt, t), budget)
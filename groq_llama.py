@@ -1,45 +1,278 @@
-
+import atexit
+import logging
 import os
-from groq import Groq
-from dotenv import load_dotenv
-load_dotenv()
+import re
+import threading
+from collections import OrderedDict, deque
+import orjson
+from groq import APIError, NOT_GIVEN
+from groq_client import call, client
 
-GROQ_API_KEY = os.getenv("GROQ_API_KEY")
-if not GROQ_API_KEY:
-    raise ValueError("GROQ_API_KEY not found in environment variables")
+logger = logging.getLogger(__name__)
 
-client = Groq(api_key=GROQ_API_KEY)
+# The system message is a fixed prefix shared by every request so the
+# provider's prompt cache can reuse it; only new turns are appended after it.
+SYSTEM_MESSAGE = {"role": "system", "content": "You are a helpful assistant responding to voice transcriptions and image analysis. Keep responses concise and natural."}
 
-# Keep track of conversation history
-conversation_history = [
-    {"role": "system", "content": "You are a helpful assistant responding to voice transcriptions and image analysis. Keep responses concise and natural."}
-]
+# Bare acknowledgements and greetings go to a smaller, faster model. Anything
+# else, however short or unpunctuated (Whisper often drops the "?"), stays on
+# the big model so its cached prompt prefix keeps being reused.
+MODEL_BY_TIER = {
+    "small": "llama-3.1-8b-instant",
+    "big": "meta-llama/llama-4-scout-17b-16e-instruct",
+}
+_TRIVIAL = re.compile(r"^(hi|hey|hello|thanks?|thank you|yes|yeah|no|nope|ok(ay)?|cool|bye|got it)[.!?]*$", re.I)
 
-def get_llama_response(transcription):
-    """Get a response from the Llama model for text-only queries"""
-    # Add user message to conversation history
-    conversation_history.append({"role": "user", "content": transcription})
-    
-    # Get response from Groq API
-    completion = client.chat.completions.create(
-        model="meta-llama/llama-4-scout-17b-16e-instruct",
-        messages=conversation_history,
-        temperature=0.7,
-        max_completion_tokens=1024,
-        top_p=1,
-        stream=False,
-        stop=None,
-    )
+def _pick_model(transcription):
+    if _TRIVIAL.match(transcription.strip()):
+        return MODEL_BY_TIER["small"]
+    return MODEL_BY_TIER["big"]
+
+# Request parameters that are the same on every call
+COMPLETION_PARAMS = {
+    "temperature": 0.7,
+    "max_completion_tokens": 256,  # the system prompt asks for concise replies
+    "top_p": 1,
+    "stream": True,
+    "stop": None,
+}
+
+# Conversation history per session (user/assistant turns only), trimmed a
+# whole exchange at a time so it never starts with an orphaned reply; the
+# least recently active session is forgotten once MAX_SESSIONS are tracked.
+CONVERSATION_WINDOW = int(os.getenv("CONVERSATION_WINDOW", "10"))  # in exchanges
+if CONVERSATION_WINDOW < 1:
+    # A zero-length deque would silently drop the user's own question
+    raise ValueError("CONVERSATION_WINDOW must be at least 1")
+MAX_HISTORY_MESSAGES = 2 * CONVERSATION_WINDOW
+MAX_SESSIONS = 1024
+HISTORY_TOKEN_BUDGET = 4000
+TRIM_BATCH = max(1, CONVERSATION_WINDOW // 2)  # exchanges trimmed at once
+_sessions = OrderedDict()
+# Running summary of the turns each session has trimmed, so dropping old
+# exchanges does not lose what they established
+_summaries = {}
+
+# Optional append-only JSONL log of every exchange and summary, replayed and
+# compacted by init_conversation_log() so sessions survive a restart; unset
+# keeps history in memory only
+CONVERSATION_LOG = os.getenv("CONVERSATION_LOG")
+_log_file = None
+
+SUMMARY_MODEL = MODEL_BY_TIER["small"]
+SUMMARY_TIMEOUT = 5.0  # seconds; a slow summary is dropped, never waited on
+SUMMARY_PROMPT = "Summarize the key facts, decisions and user intents in this conversation in at most 150 words. Fold in the earlier summary if one is given. Reply with the summary only."
+
+def _get_history(session_id):
+    history = _sessions.get(session_id)
+    if history is None:
+        history = _sessions[session_id] = deque(maxlen=MAX_HISTORY_MESSAGES)
+        if len(_sessions) > MAX_SESSIONS:
+            evicted, _ = _sessions.popitem(last=False)
+            _summaries.pop(evicted, None)
+    else:
+        _sessions.move_to_end(session_id)
+    return history
+
+def _log_records(*records):
+    if _log_file:
+        # One write per call, so an exchange's two lines land together
+        _log_file.write(b"".join(orjson.dumps(r, option=orjson.OPT_APPEND_NEWLINE) for r in records))
+        _log_file.flush()
+
+def _valid_record(record):
+    if not isinstance(record, dict) or not isinstance(record.get("session"), str):
+        return False
+    if record.get("cleared") is True or isinstance(record.get("summary"), str):
+        return True
+    return record.get("role") in ("user", "assistant") and isinstance(record.get("content"), str)
+
+def _answered_pairs(history):
+    """Only the user messages that got a reply, each followed by that reply"""
+    pairs, question = [], None
+    for message in history:
+        if message["role"] == "user":
+            question = message
+        elif question is not None:
+            pairs += (question, message)
+            question = None
+    return pairs
+
+def _replay_log(path):
+    """Rebuild each session's recent window and summary from the log, then
+    rewrite the log to hold only those"""
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return
+    with f:
+        for line in f:
+            try:
+                record = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                record = None
+            if not _valid_record(record):
+                # e.g. a line torn by a crash mid-write; compaction drops it
+                logger.warning("Skipping unreadable line in %s", path)
+                continue
+            session_id = record["session"]
+            if record.get("cleared"):
+                _sessions.pop(session_id, None)
+                _summaries.pop(session_id, None)
+            elif "summary" in record:
+                _summaries[session_id] = record["summary"]
+            else:
+                _get_history(session_id).append({"role": record["role"], "content": record["content"]})
+
+    for session_id, history in _sessions.items():
+        # maxlen may have cut an exchange in half, and a crash can leave a
+        # question without its reply; keep whole exchanges within the budget
+        messages = _answered_pairs(history)
+        while sum(map(_estimate_tokens, messages)) > HISTORY_TOKEN_BUDGET:
+            del messages[:2]
+        history.clear()
+        history.extend(messages)
+    for session_id in [s for s in _summaries if s not in _sessions]:
+        del _summaries[session_id]
+
+    # Compact: the next start reads at most MAX_SESSIONS windows, and new
+    # records are never appended onto a torn line
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as out:
+        for session_id, history in _sessions.items():
+            records = [{"session": session_id, **message} for message in history]
+            if session_id in _summaries:
+                records.insert(0, {"session": session_id, "summary": _summaries[session_id]})
+            out.write(b"".join(orjson.dumps(r, option=orjson.OPT_APPEND_NEWLINE) for r in records))
+    os.replace(tmp_path, path)
+
+def init_conversation_log(path=CONVERSATION_LOG):
+    """Restore sessions from the conversation log and keep appending to it;
+    does nothing when no log is configured"""
+    global _log_file
+    if not path or _log_file:
+        return
+    _replay_log(path)
+    _log_file = open(path, "ab")
+    atexit.register(_log_file.close)
+
+def _estimate_tokens(message):
+    # ~4 characters per token for English text, plus per-message framing
+    return len(message["content"]) // 4 + 4
+
+def _make_room(history, message):
+    """If a new exchange would overflow the message cap or the prompt token
+    budget, drop the oldest user/assistant pairs until a batch of further
+    exchanges fits; return the dropped messages"""
+    total = sum(map(_estimate_tokens, history)) + _estimate_tokens(message)
+    if len(history) + 2 <= MAX_HISTORY_MESSAGES and total <= HISTORY_TOKEN_BUDGET:
+        return []
+    # Trimming well below the limits means the summary call runs once every
+    # TRIM_BATCH turns instead of on every turn of a long session
+    message_limit = MAX_HISTORY_MESSAGES - 2 * (TRIM_BATCH - 1)
+    token_limit = HISTORY_TOKEN_BUDGET // 2
+    dropped = []
+    while history and (len(history) + 2 > message_limit or total > token_limit):
+        dropped.append(history.popleft())
+        total -= _estimate_tokens(dropped[-1])
+        if history and history[0]["role"] == "assistant":
+            dropped.append(history.popleft())
+            total -= _estimate_tokens(dropped[-1])
+    return dropped
+
+def _condense(summary, dropped):
+    """Fold trimmed messages into the session summary using the small model"""
+    text = "\n".join(f"{m['role']}: {m['content']}" for m in dropped)
+    if summary:
+        text = f"Earlier summary: {summary}\n\n{text}"
+    try:
+        completion = client.chat.completions.create(
+            model=SUMMARY_MODEL,
+            messages=[
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {"role": "user", "content": text},
+            ],
+            temperature=0.2,
+            max_completion_tokens=200,
+            stream=False,
+            timeout=SUMMARY_TIMEOUT,
+        )
+    except APIError as e:
+        # A missing summary only costs context; never fail the user's turn
+        logger.warning("Could not summarise trimmed history: %s", e)
+        return summary
+    return completion.choices[0].message.content
+
+def _refresh_summary(session_id, dropped):
+    summary = _condense(_summaries.get(session_id), dropped)
+    if summary and session_id in _sessions:  # not cleared or evicted in the meantime
+        _summaries[session_id] = summary
+        _log_records({"session": session_id, "summary": summary})
+
+def get_llama_response_stream(transcription, session_id="default", timeout=NOT_GIVEN):
+    """Yield the Llama model's reply as text deltas for text-only queries"""
+    history = _get_history(session_id)
+
+    # The user message joins the history only together with its reply, so a
+    # failed or abandoned stream leaves no unanswered turn behind
+    message = {"role": "user", "content": transcription}
+    dropped = _make_room(history, message)
+    if dropped:
+        # Summarise off the request path: this turn goes without the trimmed
+        # exchanges, and the next one gets their summary
+        threading.Thread(target=_refresh_summary, args=(session_id, dropped), daemon=True).start()
+
+    # The summary goes after the fixed system prefix so that stays cacheable
+    summary = _summaries.get(session_id)
+    recap = [{"role": "system", "content": f"Previously: {summary}"}] if summary else []
     
-    # Extract response text
-    response_text = completion.choices[0].message.content
+    # Get response from Groq API; tokens arrive as they are decoded
+    stream = call(lambda timeout: client.chat.completions.create(
+        model=_pick_model(transcription),
+        messages=[SYSTEM_MESSAGE, *recap, *history, message],
+        timeout=timeout,
+        **COMPLETION_PARAMS,
+    ), timeout)
     
-    # Add assistant response to conversation history
-    conversation_history.append({"role": "assistant", "content": response_text})
+    parts = []
+    for chunk in stream:
+        delta = chunk.choices[0].delta.content
+        if delta:
+            parts.append(delta)
+            yield delta
     
-    return response_text
+    # Record the exchange once the full reply has arrived
+    response_text = "".join(parts)
+    logger.debug("Llama reply streamed in %d chunks", len(parts))
+    reply = {"role": "assistant", "content": response_text}
+    history.extend((message, reply))
+    _log_records({"session": session_id, **message}, {"session": session_id, **reply})
+
+def get_llama_response(transcription, session_id="default", timeout=NOT_GIVEN):
+    """Get a response from the Llama model for text-only queries"""
+    return "".join(get_llama_response_stream(transcription, session_id, timeout))
+
+def clear_conversation_history(session_id="default"):
+    """Forget a session's conversation; the system message is kept separately"""
+    _sessions.pop(session_id, None)
+    _summaries.pop(session_id, None)
+    _log_records({"session": session_id, "cleared": True})
+
+if __name__ == "__main__":
+    # Offline checks of the routing, trimming and eviction rules; no API calls
+    assert _pick_model("Thanks!") == MODEL_BY_TIER["small"]
+    assert _pick_model("Which flowers suit a spring wedding?") == MODEL_BY_TIER["big"]
+    assert _pick_model("Tell me about roses") == MODEL_BY_TIER["big"]
+    assert _pick_model("recommend a gift") == MODEL_BY_TIER["big"]
+
+    history = _get_history("check")
+    for i in range(CONVERSATION_WINDOW):
+        history.extend([{"role": "user", "content": f"q{i}"}, {"role": "assistant", "content": f"a{i}"}])
+    dropped = _make_room(history, {"role": "user", "content": "next"})
+    assert len(dropped) == 2 * TRIM_BATCH and dropped[0]["content"] == "q0"
+    assert history[0]["role"] == "user" and len(history) + 2 <= MAX_HISTORY_MESSAGES
 
-def clear_conversation_history():
-    """Clear the conversation history except for the system message"""
-    global conversation_history
-    conversation_history = [conversation_history[0]]
+    for i in range(MAX_SESSIONS):
+        _get_history(f"other-{i}")
+    assert "check" not in _sessions and len(_sessions) == MAX_SESSIONS
+    print("groq_llama checks passed")
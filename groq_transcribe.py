@@ -1,40 +1,112 @@
-import os
-import base64
-from groq import Groq
-from dotenv import load_dotenv
+import hashlib
+import io
+import pybase64
+import time
+import wave
+from collections import OrderedDict
+import numpy as np
+from PIL import ExifTags, Image, ImageOps
+from groq import NOT_GIVEN
+from groq_client import call, client
 
-load_dotenv()
+MIN_SPEECH_SECONDS = 0.3
+SILENCE_RMS_THRESHOLD = 200  # int16 sample units
 
-GROQ_API_KEY = os.getenv("GROQ_API_KEY")
-if not GROQ_API_KEY:
-    raise ValueError("GROQ_API_KEY not found in environment variables")
+def is_silent(file_path):
+    """Return True if a 16-bit PCM WAV is too short or too quiet to transcribe"""
+    try:
+        with wave.open(file_path, "rb") as wf:
+            if wf.getsampwidth() != 2:
+                return False
+            nframes, framerate = wf.getnframes(), wf.getframerate()
+            if nframes < MIN_SPEECH_SECONDS * framerate:
+                return True
+            frames = wf.readframes(nframes)
+    except (wave.Error, EOFError):
+        return False  # not a WAV we understand; let the API decide
+    # A truncated file can end mid-sample; read whole samples only
+    samples = np.frombuffer(frames, dtype="<i2", count=len(frames) // 2)
+    if not samples.size:
+        return True
+    # One fused integer sum of squares; int64 cannot overflow for int16 input
+    wide = samples.astype(np.int64)
+    return np.dot(wide, wide) < SILENCE_RMS_THRESHOLD ** 2 * samples.size
 
-client = Groq(api_key=GROQ_API_KEY)
-
-def transcribe_audio(file_path):
+def transcribe_audio(file_path, timeout=NOT_GIVEN):
     """Transcribe audio to text using Groq's API"""
-    with open(file_path, "rb") as audio_file:
-        response = client.audio.transcriptions.create(
-            file=audio_file,
-            model="distil-whisper-large-v3-en"
-        )
-        return response.text
-
-def get_vision_response(transcription, image_data):
-    """Process an image and text query using the vision model"""
-    # The image_data is already in base64 from the client
-    # Extract the base64 part if it includes the data URL prefix
-    if ',' in image_data:
-        base64_image = image_data.split(',', 1)[1]
+    def attempt(timeout):
+        with open(file_path, "rb") as audio_file:
+            # Name the upload explicitly: the path may be an anonymous
+            # /proc/self/fd entry with no extension for the API to sniff.
+            return client.audio.transcriptions.create(
+                file=("speech.wav", audio_file),
+                model="distil-whisper-large-v3-en",
+                timeout=timeout
+            )
+    return call(attempt, timeout).text
+
+JPEG_QUALITY = 75
+MAX_IMAGE_SIDE = 1024  # the vision model downsizes larger images itself
+
+def prepare_image(image_bytes):
+    """Upright and downscale an image to MAX_IMAGE_SIDE and re-encode it as a
+    quality-75 JPEG, keeping an original JPEG if that would not make it smaller"""
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        is_jpeg = img.format == "JPEG"
+        resized = max(img.size) > MAX_IMAGE_SIDE
+        if resized:
+            # draft() lets the JPEG decoder skip straight to a reduced scale
+            img.draft("RGB", (MAX_IMAGE_SIDE, MAX_IMAGE_SIDE))
+        # Re-encoding drops EXIF, so bake the Orientation tag into the pixels
+        # or portrait phone photos reach the model on their side
+        rotated = img.getexif().get(ExifTags.Base.Orientation, 1) != 1
+        rgb = ImageOps.exif_transpose(img).convert("RGB")
+    rgb.thumbnail((MAX_IMAGE_SIDE, MAX_IMAGE_SIDE), Image.Resampling.LANCZOS)
+    buf = io.BytesIO()
+    rgb.save(buf, format="JPEG", quality=JPEG_QUALITY)
+    if is_jpeg and not resized and not rotated and buf.tell() >= len(image_bytes):
+        return image_bytes
+    return buf.getvalue()
+
+VISION_MODEL = "llama-3.2-11b-vision-preview"
+FOLLOW_UP_MODEL = "llama-3.1-8b-instant"
+DESCRIBE_PROMPT = "Describe this image in detail, including any visible text, so that later questions about it can be answered from the description alone."
+
+# Detailed descriptions of recent images, keyed by content hash. The heavy
+# vision model sees each image once; questions about it are then answered by
+# a small text model from the description.
+DESCRIPTION_CACHE_SIZE = 64
+_image_descriptions = OrderedDict()
+
+def _image_hash(image_data):
+    if isinstance(image_data, str):
+        prefix, sep, payload = image_data.partition(',')
+        image_data = (payload if sep else prefix).encode('ascii')
+    return hashlib.blake2b(image_data, digest_size=16).digest()
+
+def _describe_image(image_hash, image_data, timeout=NOT_GIVEN):
+    """Return the cached description of an image, asking the vision model once"""
+    description = _image_descriptions.get(image_hash)
+    if description is not None:
+        _image_descriptions.move_to_end(image_hash)
+        return description
+
+    if isinstance(image_data, (bytes, bytearray, memoryview)):
+        # Raw image bytes (e.g. a multipart upload): shrink, then encode once
+        base64_image = pybase64.b64encode_as_string(prepare_image(image_data))
     else:
-        base64_image = image_data
+        # A base64 string from the client; extract the payload if it includes
+        # the data URL prefix. partition scans the (large) string once
+        # instead of a containment check + split
+        prefix, sep, payload = image_data.partition(',')
+        base64_image = payload if sep else prefix
 
     # Create a fresh conversation for the vision model without system message
     vision_messages = [
         {
             "role": "user", 
             "content": [
-                {"type": "text", "text": transcription},
+                {"type": "text", "text": DESCRIBE_PROMPT},
                 {
                     "type": "image_url",
                     "image_url": {
@@ -45,19 +117,66 @@ def get_vision_response(transcription, image_data):
         }
     ]
 
-    # Use vision model for image + text
-    completion = client.chat.completions.create(
-        model="llama-3.2-11b-vision-preview",
+    completion = call(lambda timeout: client.chat.completions.create(
+        model=VISION_MODEL,
         messages=vision_messages,
+        temperature=0.2,
+        max_completion_tokens=400,
+        stream=False,
+        timeout=timeout,
+    ), timeout)
+    description = completion.choices[0].message.content
+
+    _image_descriptions[image_hash] = description
+    if len(_image_descriptions) > DESCRIPTION_CACHE_SIZE:
+        _image_descriptions.popitem(last=False)
+    return description
+
+def get_vision_response_stream(transcription, image_data, timeout=NOT_GIVEN):
+    """Process an image and text query, yielding text deltas"""
+    started = time.monotonic()
+    description = _describe_image(_image_hash(image_data), image_data, timeout)
+    if timeout is not NOT_GIVEN:
+        timeout -= time.monotonic() - started  # both calls share the budget
+
+    # Answer from the description; tokens arrive as they are decoded
+    stream = call(lambda timeout: client.chat.completions.create(
+        model=FOLLOW_UP_MODEL,
+        messages=[
+            {"role": "system", "content": f"You are answering questions about an image described as follows:\n{description}"},
+            {"role": "user", "content": transcription},
+        ],
         temperature=0.7,
-        max_completion_tokens=1024,
+        max_completion_tokens=300,  # a short answer; the description itself was the 400-token call
         top_p=1,
-        stream=False,
+        stream=True,
         stop=None,
-    )
+        timeout=timeout,
+    ), timeout)
+
+    for chunk in stream:
+        delta = chunk.choices[0].delta.content
+        if delta:
+            yield delta
+
+# Replies for recent (image, question) pairs so an exact repeat skips even
+# the follow-up call
+VISION_CACHE_SIZE = 128
+_vision_cache = OrderedDict()
+
+def get_vision_response(transcription, image_data, timeout=NOT_GIVEN):
+    """Process an image and text query using the vision model"""
+    key = _image_hash(image_data) + hashlib.blake2b(transcription.encode(), digest_size=16).digest()
+    cached = _vision_cache.get(key)
+    if cached is not None:
+        _vision_cache.move_to_end(key)
+        return cached
 
-    # Extract and return vision model response
-    return completion.choices[0].message.content
+    response_text = "".join(get_vision_response_stream(transcription, image_data, timeout))
+    _vision_cache[key] = response_text
+    if len(_vision_cache) > VISION_CACHE_SIZE:
+        _vision_cache.popitem(last=False)
+    return response_text
 
 if __name__ == "__main__":
     audio_path = "example_audio.wav"  # replace with actual audio file
@@ -1,5 +1,7 @@
 # recommend_flower.py
 
+import re
+
 flower_keywords = {
     "love": "Red Rose",
     "romantic": "Tulip",
@@ -19,10 +21,15 @@ flower_keywords = {
     "father": "Iris",
 }
 
+# All keywords in one pattern so the text is scanned once; the lookahead
+# reports overlapping matches too, and when several match, the one listed
+# first above still wins
+_KEYWORD_PATTERN = re.compile("(?=(%s))" % "|".join(map(re.escape, flower_keywords)))
+_PRIORITY = {keyword: i for i, keyword in enumerate(flower_keywords)}
+
 def recommend_flower(text):
-    text_lower = text.lower()
-    for keyword, flower in flower_keywords.items():
-        if keyword in text_lower:
-            return flower
-    return "Mixed Bouquet"
+    matches = _KEYWORD_PATTERN.findall(text.lower())
+    if not matches:
+        return "Mixed Bouquet"
+    return flower_keywords[min(matches, key=_PRIORITY.__getitem__)]
 
@@ -0,0 +1,91 @@
+# upstream.py
+
+import logging
+import time
+import requests
+from urllib3.exceptions import NewConnectionError
+
+logger = logging.getLogger(__name__)
+
+# The single retry layer for every API client. Only requests the server
+# refused (429/503) or never received are resent, since a POST that reached
+# a paid endpoint may already have been billed.
+MAX_ATTEMPTS = 3
+BACKOFF_BASE = 0.5  # seconds, doubled per attempt
+RETRY_WAIT_MAX = 4.0  # also caps Retry-After
+RETRY_STATUSES = (429, 503)
+
+class CircuitOpen(Exception):
+    """An upstream failed repeatedly and is not being called until it cools down"""
+
+class Transient(Exception):
+    """An attempt that is safe to resend, optionally with the server's Retry-After"""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class CircuitBreaker:
+    """Refuse calls to an upstream for `cooldown` seconds once `threshold`
+    calls in a row have failed; after that, calls go through again and the
+    first failure re-opens it"""
+
+    def __init__(self, name, threshold=5, cooldown=30.0):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._failures = 0
+        self._opened_at = 0.0
+
+    def check(self):
+        if self._failures >= self.threshold and time.monotonic() - self._opened_at < self.cooldown:
+            raise CircuitOpen(f"{self.name} is failing; not calling it for up to {self.cooldown:.0f}s")
+
+    def record_success(self):
+        self._failures = 0
+
+    def record_failure(self):
+        self._failures += 1
+        if self._failures >= self.threshold:
+            self._opened_at = time.monotonic()
+            logger.warning("%s failed %d times in a row; pausing calls for %.0fs", self.name, self._failures, self.cooldown)
+
+def retry_after(headers):
+    """Seconds from a Retry-After header, or None if absent or an HTTP date"""
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+def never_sent(exc):
+    """True if a requests exception means the request never reached the server"""
+    reason = getattr(exc.args[0], "reason", None) if exc.args else None
+    return isinstance(exc, requests.ConnectTimeout) or isinstance(reason, NewConnectionError)
+
+def call(breaker, attempt, timeout=None):
+    """Run attempt(seconds_left) through breaker, resending it while it raises
+    Transient, up to MAX_ATTEMPTS times and never past `timeout` seconds in
+    total (None: no limit); any exception counts as a failure"""
+    breaker.check()
+    # The budget covers every attempt and the waits between them, so a
+    # caller's deadline holds however many retries happen
+    deadline = None if timeout is None else time.monotonic() + timeout
+    for n in range(1, MAX_ATTEMPTS + 1):
+        remaining = None if deadline is None else deadline - time.monotonic()
+        if remaining is not None and remaining <= 0:
+            raise TimeoutError(f"no time left to call {breaker.name}")
+        try:
+            result = attempt(remaining)
+        except Transient as e:
+            wait = e.retry_after if e.retry_after is not None else BACKOFF_BASE * 2 ** (n - 1)
+            wait = min(wait, RETRY_WAIT_MAX)
+            if n == MAX_ATTEMPTS or (deadline is not None and time.monotonic() + wait >= deadline):
+                breaker.record_failure()
+                raise e.__cause__ or e
+            time.sleep(wait)
+            continue
+        except Exception:
+            breaker.record_failure()
+            raise
+        breaker.record_success()
+        return result